@@ -4,7 +4,14 @@ import altair as alt
 from io import BytesIO
 from fpdf import FPDF
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 from datetime import datetime
+from functools import partial
+import hashlib
+import tempfile
+from pathlib import Path
 
 # --- Configuración de la página ---
 st.set_page_config(layout="wide")
@@ -54,24 +61,74 @@ custom_format_locale = {
     "decimal": ",", "thousands": ".", "grouping": [3], "currency": ["$", ""]
 }
 alt.renderers.set_embed_options(formatLocale=custom_format_locale)
+# Sin el tema por defecto de Altair (tamaños fijos de 300px): Streamlit ajusta el ancho y cada gráfico fija su alto.
+alt.theme.enable('none')
+
+# --- Gráficos ---
+# st.altair_chart valida el spec completo contra el JSON Schema de Vega-Lite en cada rerun, y eso
+# es la mayor parte del costo de armar un gráfico. Los gráficos se construyen siempre igual, así que
+# se pasa a Streamlit el diccionario de Vega-Lite generado por Altair, sin validar.
+# Además, los datos de cada gráfico dependen sólo del archivo y de los filtros (chart_key): el spec
+# se cachea con esa clave y los reruns que no los cambian no vuelven a construir el gráfico.
+# Se dibuja en canvas en lugar de SVG: un solo elemento en el navegador en vez de un nodo por barra o punto.
+@st.cache_data(max_entries=256)
+def get_chart_spec(chart_name, chart_key, _build_chart):
+    spec = _build_chart().to_dict(validate=False)
+    spec['usermeta'] = {'embedOptions': {'renderer': 'canvas'}}
+    return spec
+
+def render_chart(chart_name, chart_key, build_chart):
+    st.vega_lite_chart(get_chart_spec(chart_name, chart_key, build_chart), use_container_width=True)
+
+# Intercambia separadores en una sola pasada: 1,234.56 -> 1.234,56
+SEPARADORES_ES = str.maketrans({",": ".", ".": ","})
 
 def format_number_es(num):
     if pd.isna(num) or not isinstance(num, (int, float, np.number)): return ""
-    s = f"{num:,.2f}"
-    return s.replace(",", "TEMP").replace(".", ",").replace("TEMP", ".")
+    return f"{num:,.2f}".translate(SEPARADORES_ES)
 
 def format_integer_es(num):
     if pd.isna(num) or not isinstance(num, (int, float, np.number)): return ""
-    s = f"{int(num):,}"
-    return s.replace(",", ".")
+    return f"{int(num):,}".translate(SEPARADORES_ES)
+
+# Versión para columnas completas: usa el método format de str (en C) y una sola traducción
+# vectorizada, en lugar de llamar a format_number_es celda por celda.
+def format_currency_series_es(series):
+    formatted = series.map('{:,.2f}'.format, na_action='ignore').str.translate(SEPARADORES_ES)
+    return '$' + formatted.fillna('')
+
+# --- Meses en orden calendario ---
+MESES = ['Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio', 'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre']
 
 # --- FUNCIONES DE EXPORTACIÓN ---
+# CSV generado con el escritor de Arrow (C++), sin pasar por un str intermedio de pandas.
+def to_csv(df):
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return df.to_csv(index=False).encode('utf-8')
+    # Las fechas sin hora se escriben como AAAA-MM-DD, igual que con pandas.
+    for col in df.select_dtypes(include='datetime').columns:
+        values = df[col].dropna()
+        if (values == values.dt.normalize()).all():
+            idx = table.schema.get_field_index(col)
+            table = table.set_column(idx, col, table.column(idx).cast(pa.date32()))
+    buffer = pa.BufferOutputStream()
+    pacsv.write_csv(table, buffer)
+    return buffer.getvalue().to_pybytes()
+
 def to_excel(df):
     output = BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
         df.to_excel(writer, index=False, sheet_name='Sheet1')
     return output.getvalue()
 
+# Parquet: columnar y comprimido, mucho más liviano que CSV/Excel para la tabla completa.
+def to_parquet(df):
+    output = BytesIO()
+    df.to_parquet(output, index=False, engine='pyarrow', compression='zstd')
+    return output.getvalue()
+
 def to_pdf(df, periodo):
     periodo_str = ", ".join(periodo) if isinstance(periodo, list) else str(periodo)
     html_table = df.to_html(index=False, border=0)
@@ -97,71 +154,248 @@ def to_pdf(df, periodo):
     pdf.write_html(html_content)
     return bytes(pdf.output())
 
+def to_pdf_summary(df, periodo):
+    pdf_summary_cols = ['Período', 'Nro. de Legajo', 'Apellido y Nombres', 'Gerencia', 'Clasificacion_Ministerio', 'Total Mensual']
+    existing_pdf_cols = [col for col in pdf_summary_cols if col in df.columns]
+    df_pdf_formatted = df[existing_pdf_cols].copy()
+    df_pdf_formatted['Período'] = df_pdf_formatted['Período'].dt.strftime('%Y-%m')
+    df_pdf_formatted['Total Mensual'] = format_currency_series_es(df_pdf_formatted['Total Mensual'])
+    return to_pdf(df_pdf_formatted, periodo)
+
 # --- LÓGICA DE FILTROS ---
-def apply_filters(df, selections):
-    _df = df.copy()
+# Combina todos los filtros en una sola máscara booleana para indexar el DataFrame una única vez.
+def build_filter_mask(df, selections, exclude_column=None):
+    mask = np.ones(len(df), dtype=bool)
     for col, values in selections.items():
-        if values:
-            _df = _df[_df[col].isin(values)]
-    return _df
+        if col != exclude_column and values:
+            series = df[col]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                # En columnas categóricas se comparan los códigos enteros en lugar de los textos.
+                selected_codes = series.cat.categories.get_indexer(values)
+                selected_codes = np.unique(selected_codes[selected_codes >= 0])
+                # Con todas las categorías seleccionadas el filtro no descarta filas: se omite.
+                if len(selected_codes) == len(series.cat.categories):
+                    continue
+                # Tabla de búsqueda por código: una sola indexación en lugar de np.isin. Tiene un
+                # lugar extra al final, siempre False, al que cae el código -1 de los valores nulos.
+                selected_lookup = np.zeros(len(series.cat.categories) + 1, dtype=bool)
+                selected_lookup[selected_codes] = True
+                mask &= selected_lookup[series.cat.codes.to_numpy()]
+            else:
+                mask &= series.isin(values).to_numpy()
+    return mask
+
+def apply_filters(df, selections):
+    mask = build_filter_mask(df, selections)
+    # Sin filas descartadas se devuelve el mismo DataFrame, sin copiarlo (sólo se lee).
+    return df if mask.all() else df.loc[mask]
     
 # --- INICIO: FUNCIONES PARA FILTROS INTELIGENTES ---
 def get_sorted_unique_options(dataframe, column_name):
     if column_name in dataframe.columns:
-        unique_values = dataframe[column_name].dropna().unique().tolist()
+        series = dataframe[column_name]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # Las categorías ya están ordenadas (alfabéticamente, o por mes en 'Mes'):
+            # basta con quedarse con las que aparecen, buscando sobre los códigos enteros.
+            codes = series.cat.codes.to_numpy()
+            unique_values = series.cat.categories[np.unique(codes[codes >= 0])].tolist()
+            return [v for v in unique_values if v != 'no disponible']
+        unique_values = series.dropna().unique().tolist()
         unique_values = [v for v in unique_values if v != 'no disponible']
         if column_name == 'Mes':
-            all_months_order = ['Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio', 'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre']
-            return sorted(unique_values, key=lambda m: all_months_order.index(m) if m in all_months_order else -1)
+            return sorted(unique_values, key=lambda m: MESES.index(m) if m in MESES else -1)
         return sorted(unique_values)
     return []
 
 def get_available_options(df, selections, target_column):
-    _df = df.copy()
-    for col, values in selections.items():
-        if col != target_column and values:
-            _df = _df[_df[col].isin(values)]
-    return get_sorted_unique_options(_df, target_column)
+    if target_column not in df.columns:
+        return []
+    mask = build_filter_mask(df, selections, exclude_column=target_column)
+    return get_sorted_unique_options(df.loc[mask, [target_column]], target_column)
+
+# Las opciones completas de cada filtro sólo dependen del archivo cargado: se calculan una vez por archivo.
+@st.cache_data
+def get_filter_options(_df, file_hash, columns):
+    return {col: get_sorted_unique_options(_df, col) for col in columns}
+
+# Las opciones disponibles de un filtro dependen sólo de la selección de los demás filtros:
+# se cachean con esa selección como clave, así los reruns sin cambios no recalculan las máscaras.
+@st.cache_data(max_entries=256)
+def get_cached_available_options(_df, file_hash, other_selections_key, target_column):
+    return get_available_options(_df, dict(other_selections_key), target_column)
 # --- FIN: FUNCIONES PARA FILTROS INTELIGENTES ---
 
 # --- CARGA DE DATOS ---
-@st.cache_data
-def load_data(uploaded_file):
+# El DataFrame ya procesado se guarda en Parquet, indexado por el hash del archivo cargado,
+# para no volver a parsear el Excel cuando se reinicia el servidor.
+PARQUET_CACHE_DIR = Path(tempfile.gettempdir()) / 'masa_salarial_cache'
+PARQUET_CACHE_VERSION = 9
+
+# Columnas de filtro que se guardan como 'category' para acelerar isin/groupby. Legajo y Ceco
+# se repiten en cada mes, así que también se benefician de filtrar por códigos enteros.
+CATEGORY_COLUMNS = ['Gerencia', 'Nivel', 'Clasificacion_Ministerio', 'Relación', 'Ceco', 'Legajo']
+
+CURRENCY_COLUMNS = ['Total Sujeto a Retención', 'Vacaciones', 'Alquiler', 'Horas Extras', 'Nómina General con Aportes', 'Cs. Sociales s/Remunerativos', 'Cargas Sociales Ant.', 'IC Pagado', 'Vacaciones Pagadas', 'Cargas Sociales s/Vac. Pagadas', 'Retribución Cargo 1.1.1.', 'Antigüedad 1.1.3.', 'Retribuciones Extraordinarias 1.3.1.', 'Contribuciones Patronales', 'Gratificación por Antigüedad', 'Gratificación por Jubilación', 'Total No Remunerativo', 'SAC Horas Extras', 'Cargas Sociales SAC Hextras', 'SAC Pagado', 'Cargas Sociales s/SAC Pagado', 'Cargas Sociales Antigüedad', 'Nómina General sin Aportes', 'Gratificación Única y Extraordinaria', 'Gastos de Representación', 'Contribuciones Patronales 1.3.3.', 'S.A.C. 1.3.2.', 'S.A.C. 1.1.4.', 'Contribuciones Patronales 1.1.6.', 'Complementos 1.1.7.', 'Asignaciones Familiares 1.4.', 'Total Mensual']
+
+def get_file_hash(file_bytes):
+    return hashlib.sha1(file_bytes).hexdigest()
+
+def get_parquet_cache_path(file_hash):
+    return PARQUET_CACHE_DIR / f"masa_salarial_v{PARQUET_CACHE_VERSION}_{file_hash}.parquet"
+
+def read_parquet_cache(cache_path):
+    if not cache_path.exists():
+        return None
+    try:
+        # split_blocks evita consolidar las columnas en un único bloque (una copia menos) y
+        # self_destruct libera la memoria de Arrow a medida que se convierte cada columna.
+        return pq.read_table(cache_path).to_pandas(split_blocks=True, self_destruct=True)
+    except Exception:
+        cache_path.unlink(missing_ok=True)
+        return None
+
+def write_parquet_cache(df, cache_path):
+    tmp_path = cache_path.with_suffix('.tmp')
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(tmp_path, compression='zstd')
+        tmp_path.replace(cache_path)
+        # Los archivos de versiones anteriores del procesamiento ya no se van a leer: se borran.
+        current_prefix = f"masa_salarial_v{PARQUET_CACHE_VERSION}_"
+        for stale_path in cache_path.parent.glob('masa_salarial_v*.parquet'):
+            if not stale_path.name.startswith(current_prefix):
+                stale_path.unlink(missing_ok=True)
+    except Exception:
+        # La caché en disco es opcional: si no se puede escribir, se continúa sin ella.
+        tmp_path.unlink(missing_ok=True)
+
+# Las columnas sin encabezado ('Unnamed: N', p. ej. un índice exportado o celdas con formato
+# a la derecha de la tabla) no se usan en ningún lado: se descartan al leer, sin convertirlas.
+def is_named_column(col):
+    return not str(col).startswith('Unnamed:')
+
+def read_excel_sheet(file_bytes, sheet_name):
+    try:
+        return pd.read_excel(BytesIO(file_bytes), sheet_name=sheet_name, header=0, engine='calamine', usecols=is_named_column)
+    except ImportError:
+        # Sin python-calamine instalado se usa openpyxl, más lento pero equivalente.
+        return pd.read_excel(BytesIO(file_bytes), sheet_name=sheet_name, header=0, engine='openpyxl', usecols=is_named_column)
+
+# Limpia una columna de filtro trabajando sólo sobre sus valores distintos (unas pocas decenas o
+# cientos) y la devuelve como 'category', en lugar de convertir y recortar texto fila por fila.
+def clean_key_column(series, numeric_ids=False):
+    if numeric_ids:
+        series = pd.to_numeric(series, errors='coerce').astype('Int64')
+    codes, uniques = pd.factorize(series, use_na_sentinel=False)
+    cleaned = pd.Series(uniques)
+    if numeric_ids:
+        cleaned = cleaned.astype(str).replace('<NA>', 'no disponible').fillna('no disponible')
+    cleaned = cleaned.astype(str).str.strip().replace(['', 'None', 'nan', 'nan.0', '0'], 'no disponible')
+    # Valores que quedan iguales tras limpiar (p. ej. 'A' y 'A ') comparten categoría.
+    category_codes, categories = pd.factorize(cleaned, sort=True)
+    return pd.Series(pd.Categorical.from_codes(category_codes[codes], categories=categories), index=series.index)
+
+# El contenido del archivo no se hashea en Streamlit: la clave de la caché es file_hash.
+# cache_resource conserva el DataFrame vivo entre reruns y sesiones, sin copiarlo ni serializarlo
+# en cada acceso; el resto de la app sólo lo lee (los filtros devuelven DataFrames nuevos).
+@st.cache_resource
+def load_data(_file_bytes, file_hash):
+    cache_path = get_parquet_cache_path(file_hash)
+    cached_df = read_parquet_cache(cache_path)
+    if cached_df is not None:
+        return cached_df
+
     try:
-        df = pd.read_excel(uploaded_file, sheet_name='masa_salarial', header=0, engine='openpyxl')
+        df = read_excel_sheet(_file_bytes, 'masa_salarial')
     except Exception as e:
         st.error(f"Error al leer el archivo Excel. Asegúrate de que tenga una hoja llamada 'masa_salarial'. Error: {e}")
         return pd.DataFrame()
         
-    df.columns = [str(col).strip() for col in df.columns]
-    if 'Unnamed: 0' in df.columns:
-        df = df.drop(columns=['Unnamed: 0'])
+    df.columns = [' '.join(str(col).split()) for col in df.columns]
     if 'Período' not in df.columns:
         st.error("Error Crítico: La columna 'Período' no se encuentra.")
         return pd.DataFrame()
-    df['Período'] = pd.to_datetime(df['Período'], errors='coerce')
+    # Las celdas de fecha del Excel ya llegan como datetime64; sólo se parsean si vienen como texto.
+    if not pd.api.types.is_datetime64_any_dtype(df['Período']):
+        df['Período'] = pd.to_datetime(df['Período'], errors='coerce')
     df.dropna(subset=['Período'], inplace=True)
-    df['Mes_Num'] = df['Período'].dt.month.astype(int)
-    meses_es = {1: 'Enero', 2: 'Febrero', 3: 'Marzo', 4: 'Abril', 5: 'Mayo', 6: 'Junio', 7: 'Julio', 8: 'Agosto', 9: 'Septiembre', 10: 'Octubre', 11: 'Noviembre', 12: 'Diciembre'}
-    df['Mes'] = df['Mes_Num'].map(meses_es)
+    df['Mes_Num'] = df['Período'].dt.month.astype('int8')
+    # 'Mes' es una categoría ordenada construida directamente desde los códigos del mes.
+    df['Mes'] = pd.Categorical.from_codes(df['Mes_Num'].to_numpy() - 1, categories=MESES, ordered=True)
     
     df.rename(columns={'Clasificación Ministerio de Hacienda': 'Clasificacion_Ministerio', 'Nro. de Legajo': 'Legajo'}, inplace=True)
     key_filter_columns = ['Gerencia', 'Nivel', 'Clasificacion_Ministerio', 'Relación', 'Ceco', 'Legajo']
     for col in key_filter_columns:
         if col in df.columns:
-            if col in ['Ceco', 'Legajo']:
-                df[col] = pd.to_numeric(df[col], errors='coerce').astype('Int64').astype(str).replace('<NA>', 'no disponible')
-            df[col] = df[col].astype(str).str.strip().replace(['', 'None', 'nan', 'nan.0', '0'], 'no disponible')
+            df[col] = clean_key_column(df[col], numeric_ids=col in ['Ceco', 'Legajo'])
         else:
             df[col] = 'no disponible'
+    df[CATEGORY_COLUMNS] = df[CATEGORY_COLUMNS].astype('category')
 
     if 'Dotación' in df.columns:
-        df['Dotación'] = pd.to_numeric(df['Dotación'], errors='coerce').fillna(0).astype(int)
+        df['Dotación'] = pd.to_numeric(df['Dotación'], errors='coerce').fillna(0).astype('int32')
+
+    # Conversión de todas las columnas monetarias en un único bloque. Se mantienen en float64:
+    # con montos de millones de pesos, float32 ya no representa los centavos.
+    currency_cols_present = [col for col in CURRENCY_COLUMNS if col in df.columns]
+    if currency_cols_present:
+        # Calamine ya entrega numéricas las columnas sin texto: sólo se convierten las que no lo son.
+        text_cols = [col for col in currency_cols_present if not pd.api.types.is_numeric_dtype(df[col])]
+        if text_cols:
+            df[text_cols] = df[text_cols].apply(pd.to_numeric, errors='coerce')
+        df[currency_cols_present] = df[currency_cols_present].fillna(0)
 
     df.dropna(subset=['Gerencia', 'Nivel', 'Clasificacion_Ministerio', 'Relación'], inplace=True)
     df.reset_index(drop=True, inplace=True)
+    write_parquet_cache(df, cache_path)
     return df
 
+# --- AGREGACIONES ---
+def get_selections_key(selections):
+    return tuple((col, tuple(sorted(values))) for col, values in selections.items())
+
+# El DataFrame filtrado se guarda por archivo y selección de filtros: los reruns que no tocan
+# los filtros (paginación, descargas, etc.) reutilizan el mismo objeto sin recalcular la máscara.
+# Se usa cache_resource para no copiar el DataFrame en cada acceso; el resto de la app sólo lo lee.
+@st.cache_resource(max_entries=32)
+def get_filtered_data(_df, file_hash, selections_key):
+    return apply_filters(_df, dict(selections_key))
+
+# Suma cada concepto por mes directamente sobre sus columnas, sin pasar a formato largo (melt):
+# filas = conceptos, columnas = meses en orden calendario (la categoría 'Mes' está ordenada).
+def sum_concepts_by_month(df, concept_cols):
+    return df.groupby('Mes', observed=True)[concept_cols].sum().astype('float64').T.rename_axis('Concepto')
+
+# Los KPIs y las tablas de los gráficos se cachean por archivo y selección de filtros,
+# así los reruns que no cambian los filtros (p. ej. la paginación) no vuelven a agrupar.
+@st.cache_data
+def compute_aggregations(_df_filtered, file_hash, selections_key):
+    # Una sola pasada sobre el DataFrame filtrado; los KPIs y las tres tablas se derivan de este resultado reducido.
+    base = _df_filtered.groupby(['Mes', 'Gerencia', 'Clasificacion_Ministerio'], observed=True, sort=False)[['Total Mensual', 'Dotación']].sum()
+    # 'Mes' es una categoría ordenada: agrupar por ella ya deja los meses en orden calendario.
+    mensual = base.groupby(level='Mes', observed=True).sum()
+
+    total_masa_salarial = mensual['Total Mensual'].sum()
+    cantidad_empleados = 0
+    latest_month_name = "N/A"
+    if not mensual.empty:
+        # La dotación se toma del último mes presente en los datos filtrados.
+        latest_month_name = mensual.index[-1]
+        cantidad_empleados = mensual['Dotación'].iloc[-1]
+
+    masa_mensual = mensual['Total Mensual'].reset_index()
+    gerencia_data = base['Total Mensual'].groupby(level='Gerencia', observed=True, sort=False).sum().sort_values(ascending=False).reset_index()
+    clasificacion_data = base['Total Mensual'].groupby(level='Clasificacion_Ministerio', observed=True, sort=False).sum().reset_index()
+    # Resumen anual (Mes x Clasificación), también desde el resultado reducido y en orden calendario.
+    resumen_anual = base['Total Mensual'].groupby(level=['Mes', 'Clasificacion_Ministerio'], observed=True).sum().unstack(fill_value=0)
+    return {
+        'kpis': (total_masa_salarial, cantidad_empleados, latest_month_name),
+        'mensual': masa_mensual,
+        'gerencia': gerencia_data,
+        'clasificacion': clasificacion_data,
+        'resumen_anual': resumen_anual,
+    }
+
 st.title('📊 Dashboard de Masa Salarial 2025')
 st.markdown("Análisis interactivo de los costos de la mano de obra de la compañía.")
 
@@ -171,7 +405,9 @@ if uploaded_file is None:
     st.info("Por favor, cargue un archivo para comenzar el análisis.")
     st.stop()
 
-df = load_data(uploaded_file)
+file_bytes = uploaded_file.getvalue()
+file_hash = get_file_hash(file_bytes)
+df = load_data(file_bytes, file_hash)
 
 if df.empty:
     st.error("El archivo cargado está vacío o no se pudo procesar. El dashboard no puede continuar.")
@@ -180,19 +416,20 @@ if df.empty:
 st.sidebar.header('Filtros del Dashboard')
 
 filter_cols = ['Gerencia', 'Nivel', 'Clasificacion_Ministerio', 'Relación', 'Mes', 'Ceco', 'Legajo']
+filter_options = get_filter_options(df, file_hash, tuple(filter_cols))
 
 # --- LÓGICA DE FILTROS PRINCIPAL ---
 
 # 1. INICIALIZACIÓN DEL ESTADO: Si es la primera vez que se ejecuta, llena todos los filtros.
 if 'ms_selections' not in st.session_state:
-    initial_selections = {col: get_sorted_unique_options(df, col) for col in filter_cols}
+    initial_selections = {col: list(filter_options[col]) for col in filter_cols}
     st.session_state.ms_selections = initial_selections
     # Forzamos una recarga para que el resto del script vea el estado inicial.
     st.rerun()
 
 # 2. BOTÓN DE RESETEO: Restablece el estado al inicial (todo seleccionado).
 if st.sidebar.button("🧹 Resetear Filtros", use_container_width=True, key="ms_clear"):
-    initial_selections = {col: get_sorted_unique_options(df, col) for col in filter_cols}
+    initial_selections = {col: list(filter_options[col]) for col in filter_cols}
     st.session_state.ms_selections = initial_selections
     st.rerun()
 
@@ -207,10 +444,12 @@ for col in filter_cols:
     label = col.replace('_', ' ').replace('Clasificacion Ministerio', 'Clasificación Ministerio')
 
     # Las opciones disponibles se basan en el estado actual de los otros filtros.
-    available_options = get_available_options(df, st.session_state.ms_selections, col)
+    other_selections_key = tuple(item for item in get_selections_key(st.session_state.ms_selections) if item[0] != col)
+    available_options = get_cached_available_options(df, file_hash, other_selections_key, col)
     
     # Las selecciones por defecto son las que ya están en el estado, siempre que sigan siendo válidas.
-    current_selection = [sel for sel in st.session_state.ms_selections.get(col, []) if sel in available_options]
+    available_set = set(available_options)
+    current_selection = [sel for sel in st.session_state.ms_selections.get(col, []) if sel in available_set]
     
     # Creamos el widget. El usuario puede cambiar su valor.
     selected = st.sidebar.multiselect(
@@ -228,19 +467,14 @@ if old_selections != st.session_state.ms_selections:
     st.rerun()
 
 # 5. APLICACIÓN DE FILTROS: El DataFrame filtrado se usa en el resto de la app.
-df_filtered = apply_filters(df, st.session_state.ms_selections)
-
-
-# --- INICIO DEL CUERPO PRINCIPAL DEL DASHBOARD (SIN CAMBIOS) ---
-total_masa_salarial = df_filtered['Total Mensual'].sum()
-cantidad_empleados = 0
-latest_month_name = "N/A"
-if not df_filtered.empty:
-    latest_month_num = df_filtered['Mes_Num'].max()
-    df_latest_month = df_filtered[df_filtered['Mes_Num'] == latest_month_num]
-    cantidad_empleados = df_latest_month['Dotación'].sum()
-    if not df_latest_month.empty:
-        latest_month_name = df_latest_month['Mes'].iloc[0]
+selections_key = get_selections_key(st.session_state.ms_selections)
+df_filtered = get_filtered_data(df, file_hash, selections_key)
+
+
+# --- INICIO DEL CUERPO PRINCIPAL DEL DASHBOARD ---
+aggregations = compute_aggregations(df_filtered, file_hash, selections_key)
+chart_key = (file_hash, selections_key)
+total_masa_salarial, cantidad_empleados, latest_month_name = aggregations['kpis']
 costo_medio = total_masa_salarial / cantidad_empleados if cantidad_empleados > 0 else 0
 col1, col2, col3 = st.columns(3)
 
@@ -255,7 +489,7 @@ else:
     # El resto del código de visualización no necesita cambios.
     st.subheader("Evolución Mensual de la Masa Salarial")
     col_chart1, col_table1 = st.columns([2, 1])
-    masa_mensual = df_filtered.groupby('Mes').agg({'Total Mensual': 'sum', 'Mes_Num': 'first'}).reset_index().sort_values('Mes_Num')
+    masa_mensual = aggregations['mensual']
     
     y_domain = [0, 1] 
     if not masa_mensual.empty:
@@ -268,55 +502,60 @@ else:
 
     chart_height1 = (len(masa_mensual) + 1) * 35 + 3
     with col_chart1:
-        meses_ordenados = df.sort_values('Mes_Num')['Mes'].unique().tolist()
-        base_chart1 = alt.Chart(masa_mensual).transform_window(
-            total_sum='sum(Total Mensual)'
-        ).transform_calculate(
-            percentage="datum['Total Mensual'] / datum.total_sum",
-            label_text="format(datum['Total Mensual'] / 1000000000, ',.2f') + 'G (' + format(datum.percentage, '.1%') + ')'"
-        )
-        line = base_chart1.mark_line(point=True, strokeWidth=3).encode(
-            x=alt.X('Mes:N', sort=meses_ordenados, title='Mes'), 
-            y=alt.Y('Total Mensual:Q', title='Masa Salarial ($)', axis=alt.Axis(format='$,.0s'), scale=y_scale), 
-            tooltip=[alt.Tooltip('Mes:N'), alt.Tooltip('Total Mensual:Q', format='$,.2f')]
-        )
-        text = base_chart1.mark_text(align='center', baseline='bottom', dy=-10).encode(
-            x=alt.X('Mes:N', sort=meses_ordenados), y=alt.Y('Total Mensual:Q', scale=y_scale), text='label_text:N'
-        )
-        line_chart = (line + text).properties(height=chart_height1, padding={'top': 35, 'left': 5, 'right': 5, 'bottom': 5}).configure(background='transparent').configure_view(fill='transparent')
-        st.altair_chart(line_chart, use_container_width=True)
+        meses_ordenados = filter_options['Mes']
+        def build_chart():
+            base_chart1 = alt.Chart(masa_mensual).transform_window(
+                total_sum='sum(Total Mensual)'
+            ).transform_calculate(
+                percentage="datum['Total Mensual'] / datum.total_sum",
+                label_text="format(datum['Total Mensual'] / 1000000000, ',.2f') + 'G (' + format(datum.percentage, '.1%') + ')'"
+            )
+            line = base_chart1.mark_line(point=True, strokeWidth=3).encode(
+                x=alt.X('Mes:N', sort=meses_ordenados, title='Mes'), 
+                y=alt.Y('Total Mensual:Q', title='Masa Salarial ($)', axis=alt.Axis(format='$,.0s'), scale=y_scale), 
+                tooltip=[alt.Tooltip('Mes:N'), alt.Tooltip('Total Mensual:Q', format='$,.2f')]
+            )
+            text = base_chart1.mark_text(align='center', baseline='bottom', dy=-10).encode(
+                x=alt.X('Mes:N', sort=meses_ordenados), y=alt.Y('Total Mensual:Q', scale=y_scale), text='label_text:N'
+            )
+            line_chart = (line + text).properties(height=chart_height1, padding={'top': 35, 'left': 5, 'right': 5, 'bottom': 5}).configure(background='transparent').configure_view(fill='transparent')
+            return line_chart
+        render_chart('evolucion_mensual', chart_key, build_chart)
     with col_table1:
-        masa_mensual_display = masa_mensual[['Mes', 'Total Mensual']].copy()
+        masa_mensual_display = masa_mensual[['Mes', 'Total Mensual']]
         if not masa_mensual_display.empty:
             total_row = pd.DataFrame([{'Mes': 'Total', 'Total Mensual': masa_mensual_display['Total Mensual'].sum()}])
             masa_mensual_display = pd.concat([masa_mensual_display, total_row], ignore_index=True)
         st.dataframe(masa_mensual_display.style.format({"Total Mensual": lambda x: f"${format_number_es(x)}"}).set_properties(subset=["Total Mensual"], **{'text-align': 'right'}), hide_index=True, use_container_width=True, height=chart_height1)
     
     st.write("")
+    # Como en la tabla detallada, los archivos se generan recién al hacer clic en el botón.
     col_dl_1, col_dl_2 = st.columns(2)
     with col_dl_1:
-        st.download_button(label="📥 Descargar CSV", data=masa_mensual_display.to_csv(index=False).encode('utf-8'), file_name='evolucion_mensual.csv', mime='text/csv', use_container_width=True)
+        st.download_button(label="📥 Descargar CSV", data=partial(to_csv, masa_mensual_display), file_name='evolucion_mensual.csv', mime='text/csv', use_container_width=True)
     with col_dl_2:
-        st.download_button(label="📥 Descargar Excel", data=to_excel(masa_mensual_display), file_name='evolucion_mensual.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', use_container_width=True)
+        st.download_button(label="📥 Descargar Excel", data=partial(to_excel, masa_mensual_display), file_name='evolucion_mensual.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', use_container_width=True)
 
     st.markdown("---")
     st.subheader("Masa Salarial por Gerencia")
     col_chart2, col_table2 = st.columns([3, 2])
-    gerencia_data = df_filtered.groupby('Gerencia')['Total Mensual'].sum().sort_values(ascending=False).reset_index()
+    gerencia_data = aggregations['gerencia']
     chart_height2 = (len(gerencia_data) + 1) * 35 + 3
     with col_chart2:
-        base_chart2 = alt.Chart(gerencia_data).mark_bar().encode(
-            x=alt.X('Total Mensual:Q', title='Masa Salarial ($)', axis=alt.Axis(format='$,.0s')),
-            y=alt.Y('Gerencia:N', sort='-x', title=None, axis=alt.Axis(labelLimit=120)),
-            tooltip=[alt.Tooltip('Gerencia:N', title='Gerencia'), alt.Tooltip('Total Mensual:Q', format='$,.2f')]
-        )
-        text = base_chart2.mark_text(align='left', baseline='middle', dx=5).encode(
-            x='Total Mensual:Q', y=alt.Y('Gerencia:N', sort='-x'), text=alt.Text('Total Mensual:Q', format='$,.0s'), color=alt.value('black')
-        )
-        bar_chart = (base_chart2 + text).properties(height=chart_height2, padding={'top': 25, 'left': 5, 'right': 5, 'bottom': 5}).configure(background='transparent').configure_view(fill='transparent')
-        st.altair_chart(bar_chart, use_container_width=True)
+        def build_chart():
+            base_chart2 = alt.Chart(gerencia_data).mark_bar().encode(
+                x=alt.X('Total Mensual:Q', title='Masa Salarial ($)', axis=alt.Axis(format='$,.0s')),
+                y=alt.Y('Gerencia:N', sort='-x', title=None, axis=alt.Axis(labelLimit=120)),
+                tooltip=[alt.Tooltip('Gerencia:N', title='Gerencia'), alt.Tooltip('Total Mensual:Q', format='$,.2f')]
+            )
+            text = base_chart2.mark_text(align='left', baseline='middle', dx=5).encode(
+                x='Total Mensual:Q', y=alt.Y('Gerencia:N', sort='-x'), text=alt.Text('Total Mensual:Q', format='$,.0s'), color=alt.value('black')
+            )
+            bar_chart = (base_chart2 + text).properties(height=chart_height2, padding={'top': 25, 'left': 5, 'right': 5, 'bottom': 5}).configure(background='transparent').configure_view(fill='transparent')
+            return bar_chart
+        render_chart('masa_por_gerencia', chart_key, build_chart)
     with col_table2:
-        gerencia_data_display = gerencia_data.copy()
+        gerencia_data_display = gerencia_data
         if not gerencia_data_display.empty:
             total_row = pd.DataFrame([{'Gerencia': 'Total', 'Total Mensual': gerencia_data_display['Total Mensual'].sum()}])
             gerencia_data_display = pd.concat([gerencia_data_display, total_row], ignore_index=True)
@@ -325,14 +564,14 @@ else:
     st.write("")
     col_dl_3, col_dl_4 = st.columns(2)
     with col_dl_3:
-        st.download_button(label="📥 Descargar CSV", data=gerencia_data_display.to_csv(index=False).encode('utf-8'), file_name='masa_por_gerencia.csv', mime='text/csv', use_container_width=True)
+        st.download_button(label="📥 Descargar CSV", data=partial(to_csv, gerencia_data_display), file_name='masa_por_gerencia.csv', mime='text/csv', use_container_width=True)
     with col_dl_4:
-        st.download_button(label="📥 Descargar Excel", data=to_excel(gerencia_data_display), file_name='masa_por_gerencia.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', use_container_width=True)
+        st.download_button(label="📥 Descargar Excel", data=partial(to_excel, gerencia_data_display), file_name='masa_por_gerencia.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', use_container_width=True)
     
     st.markdown("---")
     st.subheader("Distribución por Clasificación")
     col_chart3, col_table3 = st.columns([2, 1])
-    clasificacion_data = df_filtered.groupby('Clasificacion_Ministerio')['Total Mensual'].sum().reset_index()
+    clasificacion_data = aggregations['clasificacion']
     
     with col_chart3:
         clasificacion_data = clasificacion_data.sort_values('Total Mensual', ascending=False)
@@ -342,26 +581,28 @@ else:
         else:
             clasificacion_data['Porcentaje'] = 0
 
-        base_chart = alt.Chart(clasificacion_data).encode(
-            theta=alt.Theta(field="Total Mensual", type="quantitative", stack=True),
-            color=alt.Color(field="Clasificacion_Ministerio", type="nominal", title="Clasificación",
-                            sort=alt.EncodingSortField(field="Total Mensual", order="descending")),
-            tooltip=[
-                alt.Tooltip('Clasificacion_Ministerio', title='Clasificación'),
-                alt.Tooltip('Total Mensual', format='$,.2f'),
-                alt.Tooltip('Porcentaje', format='.2%')
-            ]
-        )
-        pie = base_chart.mark_arc(innerRadius=70, outerRadius=110)
-        text = base_chart.mark_text(radius=140, size=12, fill='black').encode(
-            text=alt.condition(
-                alt.datum.Porcentaje > 0.03,
-                alt.Text('Porcentaje:Q', format='.1%'),
-                alt.value('')
+        def build_chart():
+            base_chart = alt.Chart(clasificacion_data).encode(
+                theta=alt.Theta(field="Total Mensual", type="quantitative", stack=True),
+                color=alt.Color(field="Clasificacion_Ministerio", type="nominal", title="Clasificación",
+                                sort=alt.EncodingSortField(field="Total Mensual", order="descending")),
+                tooltip=[
+                    alt.Tooltip('Clasificacion_Ministerio', title='Clasificación'),
+                    alt.Tooltip('Total Mensual', format='$,.2f'),
+                    alt.Tooltip('Porcentaje', format='.2%')
+                ]
             )
-        )
-        final_chart = (pie + text).properties(height=400).configure_view(stroke=None).configure(background='transparent')
-        st.altair_chart(final_chart, use_container_width=True)
+            pie = base_chart.mark_arc(innerRadius=70, outerRadius=110)
+            text = base_chart.mark_text(radius=140, size=12, fill='black').encode(
+                text=alt.condition(
+                    alt.datum.Porcentaje > 0.03,
+                    alt.Text('Porcentaje:Q', format='.1%'),
+                    alt.value('')
+                )
+            )
+            final_chart = (pie + text).properties(height=400).configure_view(stroke=None).configure(background='transparent')
+            return final_chart
+        render_chart('distribucion_clasificacion', chart_key, build_chart)
 
     with col_table3:
         table_data = clasificacion_data.rename(columns={'Clasificacion_Ministerio': 'Clasificación'})
@@ -370,14 +611,14 @@ else:
             total_row = pd.DataFrame([{'Clasificación': 'Total', 'Total Mensual': table_display_data['Total Mensual'].sum()}])
             table_display_data = pd.concat([table_display_data, total_row], ignore_index=True)
         table_height = (len(table_display_data) + 1) * 35 + 3
-        st.dataframe(table_display_data.copy().style.format({"Total Mensual": lambda x: f"${format_number_es(x)}"}).set_properties(subset=["Total Mensual"], **{'text-align': 'right'}), hide_index=True, use_container_width=True, height=table_height)
+        st.dataframe(table_display_data.style.format({"Total Mensual": lambda x: f"${format_number_es(x)}"}).set_properties(subset=["Total Mensual"], **{'text-align': 'right'}), hide_index=True, use_container_width=True, height=table_height)
     
     st.write("")
     col_dl_5, col_dl_6 = st.columns(2)
     with col_dl_5:
-        st.download_button(label="📥 Descargar CSV", data=table_display_data.to_csv(index=False).encode('utf-8'), file_name='distribucion_clasificacion.csv', mime='text/csv', use_container_width=True)
+        st.download_button(label="📥 Descargar CSV", data=partial(to_csv, table_display_data), file_name='distribucion_clasificacion.csv', mime='text/csv', use_container_width=True)
     with col_dl_6:
-        st.download_button(label="📥 Descargar Excel", data=to_excel(table_display_data), file_name='distribucion_clasificacion.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', use_container_width=True)
+        st.download_button(label="📥 Descargar Excel", data=partial(to_excel, table_display_data), file_name='distribucion_clasificacion.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', use_container_width=True)
 
     st.markdown("---")
     st.subheader("Masa Salarial por Concepto")
@@ -392,12 +633,7 @@ else:
     concept_cols_present = [col for col in concept_columns_to_pivot if col in df_filtered.columns]
 
     if concept_cols_present:
-        df_melted = df_filtered.melt(id_vars=['Mes', 'Mes_Num'], value_vars=concept_cols_present, var_name='Concepto', value_name='Monto')
-        pivot_table = pd.pivot_table(df_melted, values='Monto', index='Concepto', columns='Mes', aggfunc='sum', fill_value=0)
-        
-        meses_en_datos = df_filtered[['Mes', 'Mes_Num']].drop_duplicates().sort_values('Mes_Num')['Mes'].tolist()
-        if all(mes in pivot_table.columns for mes in meses_en_datos):
-            pivot_table = pivot_table[meses_en_datos]
+        pivot_table = sum_concepts_by_month(df_filtered, concept_cols_present)
 
         pivot_table['Total general'] = pivot_table.sum(axis=1)
         pivot_table = pivot_table.reindex(concept_cols_present).dropna(how='all')
@@ -411,14 +647,16 @@ else:
             
             chart_height_concepto = (len(chart_data_concepto) + 1) * 35 + 3
             
-            base_chart_concepto = alt.Chart(chart_data_concepto).mark_bar().encode(
-                x=alt.X('Total general:Q', title='Masa Salarial ($)', axis=alt.Axis(format='$,.0s')),
-                y=alt.Y('Concepto:N', sort='-x', title=None, axis=alt.Axis(labelLimit=200)),
-                tooltip=[alt.Tooltip('Concepto:N'), alt.Tooltip('Total general:Q', format='$,.2f', title='Total')]
-            )
-            text_labels_concepto = base_chart_concepto.mark_text(align='left', baseline='middle', dx=3).encode(text=alt.Text('Total general:Q', format='$,.0s'))
-            bar_chart_concepto = (base_chart_concepto + text_labels_concepto).properties(height=chart_height_concepto, padding={'top': 25, 'left': 5, 'right': 5, 'bottom': 5}).configure(background='transparent').configure_view(fill='transparent')
-            st.altair_chart(bar_chart_concepto, use_container_width=True)
+            def build_chart():
+                base_chart_concepto = alt.Chart(chart_data_concepto).mark_bar().encode(
+                    x=alt.X('Total general:Q', title='Masa Salarial ($)', axis=alt.Axis(format='$,.0s')),
+                    y=alt.Y('Concepto:N', sort='-x', title=None, axis=alt.Axis(labelLimit=200)),
+                    tooltip=[alt.Tooltip('Concepto:N'), alt.Tooltip('Total general:Q', format='$,.2f', title='Total')]
+                )
+                text_labels_concepto = base_chart_concepto.mark_text(align='left', baseline='middle', dx=3).encode(text=alt.Text('Total general:Q', format='$,.0s'))
+                bar_chart_concepto = (base_chart_concepto + text_labels_concepto).properties(height=chart_height_concepto, padding={'top': 25, 'left': 5, 'right': 5, 'bottom': 5}).configure(background='transparent').configure_view(fill='transparent')
+                return bar_chart_concepto
+            render_chart('masa_por_concepto', chart_key, build_chart)
 
         with col_table_concepto:
             st.dataframe(pivot_table.style.format(formatter=lambda x: f"${format_number_es(x)}").set_properties(**{'text-align': 'right'}), use_container_width=True, height=chart_height_concepto + 35)
@@ -426,15 +664,14 @@ else:
         st.write("")
         col_dl_7, col_dl_8 = st.columns(2)
         with col_dl_7:
-            st.download_button(label="📥 Descargar CSV", data=pivot_table.to_csv(index=True).encode('utf-8'), file_name='masa_por_concepto.csv', mime='text/csv', use_container_width=True)
+            st.download_button(label="📥 Descargar CSV", data=partial(pivot_table.to_csv, index=True), file_name='masa_por_concepto.csv', mime='text/csv', use_container_width=True)
         with col_dl_8:
-            st.download_button(label="📥 Descargar Excel", data=to_excel(pivot_table.reset_index()), file_name='masa_por_concepto.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', use_container_width=True)
+            st.download_button(label="📥 Descargar Excel", data=partial(to_excel, pivot_table.reset_index()), file_name='masa_por_concepto.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', use_container_width=True)
     else:
         st.info("No hay datos de conceptos para mostrar con los filtros seleccionados.")
 
     st.markdown("---")
     st.subheader("Resumen por Concepto (SIPAF)")
-    df_filtered.columns = df_filtered.columns.str.strip().str.replace(r"\s+", " ", regex=True)
     concept_columns_sipaf = [
         'Retribución Cargo 1.1.1', 'Antigüedad 1.1.3', 'Retribuciones Extraordinarias 1.3.1',
         'Contribuciones Patronales 1.3.3', 'SAC 1.3.2', 'SAC 1.1.4',
@@ -447,12 +684,7 @@ else:
                 sipaf_cols_present.append(col)
     
     if sipaf_cols_present:
-        df_melted_sipaf = df_filtered.melt(id_vars=['Mes', 'Mes_Num'], value_vars=sipaf_cols_present, var_name='Concepto', value_name='Monto')
-        pivot_table_sipaf = pd.pivot_table(df_melted_sipaf, values='Monto', index='Concepto', columns='Mes', aggfunc='sum', fill_value=0)
-        meses_en_datos_sipaf = df_filtered[['Mes', 'Mes_Num']].drop_duplicates().sort_values('Mes_Num')['Mes'].tolist()
-        
-        if meses_en_datos_sipaf and all(mes in pivot_table_sipaf.columns for mes in meses_en_datos_sipaf):
-            pivot_table_sipaf = pivot_table_sipaf[meses_en_datos_sipaf]
+        pivot_table_sipaf = sum_concepts_by_month(df_filtered, sipaf_cols_present).sort_index()
             
         pivot_table_sipaf['Total general'] = pivot_table_sipaf.sum(axis=1)
         pivot_table_sipaf = pivot_table_sipaf.dropna(how='all')
@@ -469,14 +701,16 @@ else:
             
             chart_height_sipaf = (len(chart_data_sipaf) + 1) * 35 + 3
 
-            base_chart_sipaf = alt.Chart(chart_data_sipaf).mark_bar().encode(
-                x=alt.X('Total general:Q', title='Masa Salarial ($)', axis=alt.Axis(format='$,.0s')),
-                y=alt.Y('Concepto:N', sort='-x', title=None, axis=alt.Axis(labelLimit=200)),
-                tooltip=[alt.Tooltip('Concepto:N'), alt.Tooltip('Total general:Q', format='$,.2f', title='Total')]
-            )
-            text_labels_sipaf = base_chart_sipaf.mark_text(align='left', baseline='middle', dx=3).encode(text=alt.Text('Total general:Q', format='$,.0s'))
-            bar_chart_sipaf = (base_chart_sipaf + text_labels_sipaf).properties(height=chart_height_sipaf, padding={'top': 25, 'left': 5, 'right': 5, 'bottom': 5}).configure(background='transparent').configure_view(fill='transparent')
-            st.altair_chart(bar_chart_sipaf, use_container_width=True)
+            def build_chart():
+                base_chart_sipaf = alt.Chart(chart_data_sipaf).mark_bar().encode(
+                    x=alt.X('Total general:Q', title='Masa Salarial ($)', axis=alt.Axis(format='$,.0s')),
+                    y=alt.Y('Concepto:N', sort='-x', title=None, axis=alt.Axis(labelLimit=200)),
+                    tooltip=[alt.Tooltip('Concepto:N'), alt.Tooltip('Total general:Q', format='$,.2f', title='Total')]
+                )
+                text_labels_sipaf = base_chart_sipaf.mark_text(align='left', baseline='middle', dx=3).encode(text=alt.Text('Total general:Q', format='$,.0s'))
+                bar_chart_sipaf = (base_chart_sipaf + text_labels_sipaf).properties(height=chart_height_sipaf, padding={'top': 25, 'left': 5, 'right': 5, 'bottom': 5}).configure(background='transparent').configure_view(fill='transparent')
+                return bar_chart_sipaf
+            render_chart('resumen_sipaf', chart_key, build_chart)
 
         with col_table_sipaf:
             table_height_sipaf = chart_height_sipaf + 35 
@@ -485,30 +719,30 @@ else:
         st.write("")
         col_dl_9, col_dl_10 = st.columns(2)
         with col_dl_9:
-            st.download_button(label="📥 Descargar CSV", data=pivot_table_sipaf.to_csv(index=True).encode('utf-8'), file_name='resumen_sipaf.csv', mime='text/csv', use_container_width=True)
+            st.download_button(label="📥 Descargar CSV", data=partial(pivot_table_sipaf.to_csv, index=True), file_name='resumen_sipaf.csv', mime='text/csv', use_container_width=True)
         with col_dl_10:
-            st.download_button(label="📥 Descargar Excel", data=to_excel(pivot_table_sipaf.reset_index()), file_name='resumen_sipaf.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', use_container_width=True)
+            st.download_button(label="📥 Descargar Excel", data=partial(to_excel, pivot_table_sipaf.reset_index()), file_name='resumen_sipaf.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', use_container_width=True)
     else:
         st.info("No hay datos de conceptos SIPAF para mostrar con los filtros seleccionados.")
 
     st.markdown("---")
     st.subheader("Tabla de Datos Detallados")
-    df_display = df_filtered.copy().reset_index(drop=True)
+    # Las descargas y la tabla paginada no usan el índice ni modifican los datos: no hace falta copiar ni reindexar.
+    df_display = df_filtered
     if not df_display.empty:
         st.markdown("##### Descargar datos")
-        col_btn1, col_btn2, col_btn3 = st.columns(3)
+        # Los archivos de la tabla completa se generan recién cuando el usuario hace clic en el botón,
+        # no en cada rerun.
+        col_btn1, col_btn2, col_btn3, col_btn4 = st.columns(4)
         with col_btn1:
-            st.download_button(label="📥 CSV (Tabla Completa)", data=df_display.to_csv(index=False).encode('utf-8'), file_name='datos_detallados.csv', mime='text/csv', use_container_width=True)
+            st.download_button(label="📥 CSV (Tabla Completa)", data=partial(to_csv, df_display), file_name='datos_detallados.csv', mime='text/csv', use_container_width=True)
         with col_btn2:
-            st.download_button(label="📥 Excel (Tabla Completa)", data=to_excel(df_display), file_name='datos_detallados.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', use_container_width=True)
+            st.download_button(label="📥 Excel (Tabla Completa)", data=partial(to_excel, df_display), file_name='datos_detallados.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', use_container_width=True)
         with col_btn3:
-            pdf_summary_cols = ['Período', 'Nro. de Legajo', 'Apellido y Nombres', 'Gerencia', 'Clasificacion_Ministerio', 'Total Mensual']
-            existing_pdf_cols = [col for col in pdf_summary_cols if col in df_display.columns]
-            df_pdf_raw = df_display[existing_pdf_cols]
-            df_pdf_formatted = df_pdf_raw.copy()
-            df_pdf_formatted['Período'] = df_pdf_formatted['Período'].dt.strftime('%Y-%m')
-            df_pdf_formatted['Total Mensual'] = df_pdf_formatted['Total Mensual'].apply(lambda x: f"${format_number_es(x)}")
-            st.download_button(label="📥 PDF (Resumen)", data=to_pdf(df_pdf_formatted, st.session_state.ms_selections.get('Mes', [])), file_name='resumen_detallado.pdf', mime='application/pdf', use_container_width=True)
+            periodo = list(st.session_state.ms_selections.get('Mes', []))
+            st.download_button(label="📥 PDF (Resumen)", data=partial(to_pdf_summary, df_display, periodo), file_name='resumen_detallado.pdf', mime='application/pdf', use_container_width=True)
+        with col_btn4:
+            st.download_button(label="📥 Parquet (Tabla Completa)", data=partial(to_parquet, df_display), file_name='datos_detallados.parquet', mime='application/octet-stream', use_container_width=True)
         
         st.write("")
         if 'page_number' not in st.session_state: st.session_state.page_number = 0
@@ -525,31 +759,23 @@ else:
         start_idx = st.session_state.page_number * PAGE_SIZE
         end_idx = min(start_idx + PAGE_SIZE, total_rows)
         df_page = df_display.iloc[start_idx:end_idx]
-        currency_columns = ['Total Sujeto a Retención', 'Vacaciones', 'Alquiler', 'Horas Extras', 'Nómina General con Aportes', 'Cs. Sociales s/Remunerativos', 'Cargas Sociales Ant.', 'IC Pagado', 'Vacaciones Pagadas', 'Cargas Sociales s/Vac. Pagadas', 'Retribución Cargo 1.1.1.', 'Antigüedad 1.1.3.', 'Retribuciones Extraordinarias 1.3.1.', 'Contribuciones Patronales', 'Gratificación por Antigüedad', 'Gratificación por Jubilación', 'Total No Remunerativo', 'SAC Horas Extras', 'Cargas Sociales SAC Hextras', 'SAC Pagado', 'Cargas Sociales s/SAC Pagado', 'Cargas Sociales Antigüedad', 'Nómina General sin Aportes', 'Gratificación Única y Extraordinaria', 'Gastos de Representación', 'Contribuciones Patronales 1.3.3.', 'S.A.C. 1.3.2.', 'S.A.C. 1.1.4.', 'Contribuciones Patronales 1.1.6.', 'Complementos 1.1.7.', 'Asignaciones Familiares 1.4.', 'Total Mensual']
         integer_columns = ['Nro. de Legajo', 'Dotación', 'Ceco']
         
-        currency_formatter = lambda x: f"${format_number_es(x)}"
-        format_mapper = {col: currency_formatter for col in currency_columns if col in df_page.columns}
-        for col in integer_columns:
-            if col in df_page.columns:
-                format_mapper[col] = format_integer_es
-        
-        columns_to_align_right = [col for col in currency_columns + integer_columns if col in df_page.columns]
-        st.dataframe(df_page.style.format(format_mapper, na_rep="").set_properties(subset=columns_to_align_right, **{'text-align': 'right'}), use_container_width=True, hide_index=True)
+        # El formato numérico lo aplica el navegador: los valores viajan como números, sin Styler celda por celda.
+        column_config = {
+            col: st.column_config.NumberColumn(format="localized")
+            for col in CURRENCY_COLUMNS + integer_columns
+            if col in df_page.columns and pd.api.types.is_numeric_dtype(df_page[col])
+        }
+        st.dataframe(df_page, column_config=column_config, use_container_width=True, hide_index=True)
 
     st.markdown("---")
     st.subheader("Resumen de Evolución Anual (Datos Filtrados)")
     
-    summary_df_filtered = pd.pivot_table(
-        df_filtered,
-        values='Total Mensual',
-        index=['Mes_Num', 'Mes'],
-        columns='Clasificacion_Ministerio',
-        aggfunc='sum',
-        fill_value=0
-    ).sort_index(level='Mes_Num').reset_index(level='Mes_Num', drop=True)
-
-    summary_df_display = summary_df_filtered.reset_index().copy()
+    summary_df_filtered = aggregations['resumen_anual']
+
+    summary_df_display = summary_df_filtered.reset_index()
+    summary_df_display['Mes'] = summary_df_display['Mes'].astype(str)
     
     if not summary_df_display.empty:
         col_chart_anual, col_table_anual = st.columns([2, 1])
@@ -570,42 +796,49 @@ else:
             st.dataframe(summary_df_display.style.format(summary_format_mapper, na_rep="").set_properties(subset=summary_currency_cols, **{'text-align': 'right'}), use_container_width=True, hide_index=True, height=table_height_anual)
         
         with col_chart_anual:
-            summary_chart_data = summary_df_filtered.reset_index().melt(id_vars='Mes', var_name='Clasificacion', value_name='Masa Salarial')
+            # La pivot ya trae una fila por (Mes, Clasificación): Vega recibe los valores sumados y no vuelve a agregar.
+            # El formato largo se arma directamente desde el bloque numpy de la pivot, sin melt.
+            def build_chart():
+                summary_values = summary_df_filtered.to_numpy()
+                summary_chart_data = pd.DataFrame({
+                    'Mes': np.repeat(summary_df_filtered.index.to_numpy(), summary_values.shape[1]),
+                    'Clasificacion': np.tile(summary_df_filtered.columns.to_numpy(), summary_values.shape[0]),
+                    'Masa Salarial': summary_values.ravel(),
+                })
+                summary_totals = summary_df_filtered.sum(axis=1).rename('total_masa_salarial').reset_index()
             
-            mes_sort_order = summary_chart_data['Mes'].dropna().unique().tolist()
-
-            bar_chart = alt.Chart(summary_chart_data).mark_bar().encode(
-                x=alt.X('Mes:N', sort=mes_sort_order, title='Mes'),
-                y=alt.Y('sum(Masa Salarial):Q', title='Masa Salarial ($)', axis=alt.Axis(format='$,.0s')),
-                color=alt.Color('Clasificacion:N', title='Clasificación'),
-                tooltip=[alt.Tooltip('Mes:N'), alt.Tooltip('Clasificacion:N'), alt.Tooltip('sum(Masa Salarial):Q', format='$,.2f', title='Masa Salarial')]
-            )
+                mes_sort_order = summary_df_filtered.index.tolist()
+
+                bar_chart = alt.Chart(summary_chart_data).mark_bar().encode(
+                    x=alt.X('Mes:N', sort=mes_sort_order, title='Mes'),
+                    y=alt.Y('Masa Salarial:Q', title='Masa Salarial ($)', axis=alt.Axis(format='$,.0s')),
+                    color=alt.Color('Clasificacion:N', title='Clasificación'),
+                    tooltip=[alt.Tooltip('Mes:N'), alt.Tooltip('Clasificacion:N'), alt.Tooltip('Masa Salarial:Q', format='$,.2f', title='Masa Salarial')]
+                )
             
-            text_labels = alt.Chart(summary_chart_data).transform_aggregate(
-                total_masa_salarial='sum(Masa Salarial)',
-                groupby=['Mes']
-            ).mark_text(
-                dy=-8,
-                align='center',
-                color='black'
-            ).encode(
-                x=alt.X('Mes:N', sort=mes_sort_order),
-                y=alt.Y('total_masa_salarial:Q'),
-                text=alt.Text('total_masa_salarial:Q', format='$,.2s')
-            )
+                text_labels = alt.Chart(summary_totals).mark_text(
+                    dy=-8,
+                    align='center',
+                    color='black'
+                ).encode(
+                    x=alt.X('Mes:N', sort=mes_sort_order),
+                    y=alt.Y('total_masa_salarial:Q'),
+                    text=alt.Text('total_masa_salarial:Q', format='$,.2s')
+                )
             
-            summary_chart = (bar_chart + text_labels).properties(
-                height=350, padding={'top': 25, 'left': 5, 'right': 5, 'bottom': 5}
-            ).configure(
-                background='transparent'
-            ).configure_view(
-                fill='transparent'
-            )
-            st.altair_chart(summary_chart, use_container_width=True)
+                summary_chart = (bar_chart + text_labels).properties(
+                    height=350, padding={'top': 25, 'left': 5, 'right': 5, 'bottom': 5}
+                ).configure(
+                    background='transparent'
+                ).configure_view(
+                    fill='transparent'
+                )
+                return summary_chart
+            render_chart('resumen_anual', chart_key, build_chart)
             
         st.write("")
         col_dl_11, col_dl_12 = st.columns(2)
         with col_dl_11:
-            st.download_button(label="📥 Descargar CSV", data=summary_df_display.to_csv(index=False).encode('utf-8'), file_name='resumen_anual_filtrado.csv', mime='text/csv', use_container_width=True)
+            st.download_button(label="📥 Descargar CSV", data=partial(to_csv, summary_df_display), file_name='resumen_anual_filtrado.csv', mime='text/csv', use_container_width=True)
         with col_dl_12:
-            st.download_button(label="📥 Descargar Excel", data=to_excel(summary_df_display), file_name='resumen_anual_filtrado.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', use_container_width=True)
\ No newline at end of file
+            st.download_button(label="📥 Descargar Excel", data=partial(to_excel, summary_df_display), file_name='resumen_anual_filtrado.xlsx', mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', use_container_width=True)
\ No newline at end of file